@@ -0,0 +1,92 @@
+import numpy as np
+from numba import njit
+
+@njit(cache=True)
+def _find(parent, label):
+    """Find the root label with path halving"""
+    while parent[label] != label:
+        parent[label] = parent[parent[label]]
+        label = parent[label]
+    return label
+
+@njit(cache=True)
+def _union(parent, a, b):
+    """Merge two label trees, keeping the smaller root"""
+    root_a = _find(parent, a)
+    root_b = _find(parent, b)
+    if root_a < root_b:
+        parent[root_b] = root_a
+    elif root_b < root_a:
+        parent[root_a] = root_b
+
+@njit(cache=True)
+def largest_component_bbox(mask):
+    """
+    Bounding box of the largest 8-connected component in a binary mask
+
+    Two-pass connected-components labelling with union-find, tracking per-label
+    pixel count and extents, so no contour arrays are ever materialized.
+
+    Args:
+        mask: uint8 mask (non-zero = foreground), e.g. from cv2.inRange
+
+    Returns:
+        Tuple of (x, y, w, h, area); area is 0 when the mask is empty
+    """
+    height, width = mask.shape
+    labels = np.zeros((height, width), np.int32)
+    # With 8-connectivity a new label needs a gap of one pixel on every side
+    parent = np.empty((height // 2 + 1) * (width // 2 + 1) + 1, np.int32)
+    next_label = 1
+
+    # First pass: provisional labels from the already-visited W, NW, N, NE neighbours
+    for y in range(height):
+        for x in range(width):
+            if mask[y, x] == 0:
+                continue
+            label = 0
+            for dy, dx in ((0, -1), (-1, -1), (-1, 0), (-1, 1)):
+                ny = y + dy
+                nx = x + dx
+                if ny < 0 or nx < 0 or nx >= width:
+                    continue
+                neighbour = labels[ny, nx]
+                if neighbour == 0:
+                    continue
+                if label == 0:
+                    label = neighbour
+                elif neighbour != label:
+                    _union(parent, label, neighbour)
+            if label == 0:
+                label = next_label
+                parent[label] = label
+                next_label += 1
+            labels[y, x] = label
+
+    if next_label == 1:
+        return 0, 0, 0, 0, 0
+
+    # Second pass: accumulate count and extents per root label
+    count = np.zeros(next_label, np.int64)
+    xmin = np.full(next_label, width, np.int32)
+    ymin = np.full(next_label, height, np.int32)
+    xmax = np.full(next_label, -1, np.int32)
+    ymax = np.full(next_label, -1, np.int32)
+    for y in range(height):
+        for x in range(width):
+            label = labels[y, x]
+            if label == 0:
+                continue
+            root = _find(parent, label)
+            count[root] += 1
+            if x < xmin[root]:
+                xmin[root] = x
+            if x > xmax[root]:
+                xmax[root] = x
+            if y < ymin[root]:
+                ymin[root] = y
+            if y > ymax[root]:
+                ymax[root] = y
+
+    best = np.argmax(count)
+    return xmin[best], ymin[best], xmax[best] - xmin[best] + 1, ymax[best] - ymin[best] + 1, count[best]
@@ -3,13 +3,27 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
 from typing import Optional, List
-import base64
-import io
-from PIL import Image
+from collections import OrderedDict
+from types import SimpleNamespace
+import ast
+import asyncio
+import functools
+import math
+import os
+import time
 import numpy as np
 import cv2
 import logging
+import pybase64
 import torch
+import torch.nn.functional as F
+import torchvision
+import xxhash
+
+from color_kernels import largest_component_bbox
+from stereo_backend import router as stereo_router, process_vision as process_vision_stereo, get_stereo_vision
+from stereo_backend import VisionResponse as StereoVisionResponse
+from stereo_vision import COLOR_RANGES
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -18,11 +32,17 @@ logger = logging.getLogger(__name__)
 # Lifespan event handler for YOLO model loading
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: load YOLO model
-    load_yolo_model()
+    # Startup: load the selected detector and start the GPU micro-batcher
+    global batch_queue
+    load_model()
+    worker = None
+    if yolo_model is not None and torch.cuda.is_available():
+        batch_queue = asyncio.Queue()
+        worker = asyncio.create_task(batch_worker())
     yield
-    # Shutdown: cleanup if needed
-    pass
+    # Shutdown: stop the micro-batcher
+    if worker is not None:
+        worker.cancel()
 
 app = FastAPI(title="YOLO Backend for NeuroSeeker", version="1.0.0", lifespan=lifespan)
 
@@ -35,6 +55,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# /api/stereo_vision lives in stereo_backend; one app serves every endpoint
+app.include_router(stereo_router)
+
+# Detector behind /api/vision: "yolo" (color fallback if YOLO fails to load),
+# "color" (skip loading YOLO entirely) or "stereo" (monocular stereo pipeline)
+DETECTOR = os.environ.get("DETECTOR", "yolo").lower()
+
 # Request/Response models matching the frontend expectations
 class VisionRequest(BaseModel):
     image_base64: str
@@ -50,87 +77,487 @@ class VisionResponse(BaseModel):
 # Global variable for YOLO model (will be loaded on startup)
 yolo_model = None
 
+# Detector variant: the nano model is plenty for a handful of navigation targets
+# (same COCO labels as yolov5s at ~1.3x the throughput)
+YOLO_WEIGHTS = os.environ.get("YOLO_WEIGHTS", "yolov5n")
+# Smaller nets are less confident, so the nano model gets a lower threshold
+YOLO_CONF = 0.4 if YOLO_WEIGHTS == "yolov5n" else 0.5
+
+# ONNX model for CPU-only hosts, run by ONNX Runtime with the OpenVINO EP; exported with:
+#   python export.py --weights yolov5n.pt --include onnx --dynamic --opset 17
+YOLO_ONNX_PATH = os.environ.get("YOLO_ONNX", os.path.join(os.path.dirname(__file__), f"{YOLO_WEIGHTS}.onnx"))
+
+# TensorRT FP16 engine exported once at build time with:
+#   python export.py --weights yolov5n.pt --include engine --half --imgsz 640
+YOLO_ENGINE_PATH = os.environ.get("YOLO_ENGINE", os.path.join(os.path.dirname(__file__), f"{YOLO_WEIGHTS}.engine"))
+
+# How the CUDA PyTorch backbone is optimized at startup: "inductor" (torch.compile),
+# "jit" (torch.jit.trace + freeze, no compiler toolchain needed) or "none"
+YOLO_COMPILE = os.environ.get("YOLO_COMPILE", "inductor")
+
+# Whether the PyTorch model runs in FP16 (set on load for Volta+ GPUs)
+yolo_fp16 = False
+
+# Whether the PyTorch model and its input buffer use NHWC (channels_last) layout
+yolo_channels_last = False
+
+# Square network input size used by the GPU letterbox path
+YOLO_INPUT_SIZE = 640
+
+# Micro-batching of concurrent GPU requests into one forward pass
+MAX_BATCH = 8
+MAX_WAIT = 0.005  # Seconds to wait for more requests before running a batch
+batch_queue = None
+
+# Preallocated model input: pinned host staging buffer, device buffer and the
+# event marking when the last host->device copy finished
+input_host = None
+input_device = None
+input_copied = None
+resize_buffer = None
+
+# Map target descriptions to COCO classes
+# COCO class names: https://github.com/ultralytics/yolov5/blob/master/data/coco.yaml
+TARGET_TO_COCO = {
+    # Basic shapes - map to similar COCO classes
+    "Red Cube": ["tv", "remote", "book"],  # Box-like objects
+    "Pink Sphere": ["sports ball", "orange", "apple"],  # Round objects
+    "Green Cone": ["traffic light", "bottle", "vase"],  # Cone-like objects
+    "Yellow Cylinder": ["bottle", "cup", "vase"],  # Cylinder-like objects
+    "Skeleton Head": ["person", "teddy bear", "clock"],  # Person-like or head-like
+    
+    # Also check for partial matches
+    "Cube": ["tv", "remote", "book"],
+    "Sphere": ["sports ball", "orange", "apple"],
+    "Cone": ["traffic light", "bottle", "vase"],
+    "Cylinder": ["bottle", "cup", "vase"],
+    "Pyramid": ["orange", "apple", "sports ball"],
+    "Skeleton": ["person", "teddy bear", "clock"],
+    "Head": ["person", "teddy bear", "clock"],
+}
+
+# Color ranges are shared with the stereo pipeline (stereo_vision.COLOR_RANGES)
+COLOR_TARGETS = list(COLOR_RANGES)
+COLOR_LOWERS = np.stack([lower for lower, _ in COLOR_RANGES.values()]).astype(np.uint8)
+COLOR_UPPERS = np.stack([upper for _, upper in COLOR_RANGES.values()]).astype(np.uint8)
+
+# Integer class-ID tables, built once the model (and its class names) is loaded
+CLASS_NAME_TO_ID = {}
+TARGET_TO_IDS = {}
+
+# LRU cache of YOLO results keyed by (frame hash, target description)
+DETECTION_CACHE_SIZE = 128
+DETECTION_CACHE_TTL = 2.0  # Seconds before the whole cache is invalidated
+detection_cache = OrderedDict()
+detection_cache_cleared_at = time.monotonic()
+
+def load_model():
+    """Load whatever the configured DETECTOR needs; only YOLO holds model weights"""
+    if DETECTOR == "yolo":
+        return load_yolo_model()
+    if DETECTOR == "stereo":
+        # Build the matcher pool and warm the depth kernel before the first request
+        get_stereo_vision()
+    logger.info(f"DETECTOR={DETECTOR}: skipping YOLO model load")
+    return False
+
 def load_yolo_model():
     """Load YOLO model on startup"""
-    global yolo_model
+    global yolo_model, yolo_fp16, yolo_channels_last
     try:
-        logger.info("Loading YOLOv5 model...")
-        # Load YOLOv5 model from torch hub with trust_repo=True to avoid warning
-        yolo_model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True, trust_repo=True)
-        yolo_model.conf = 0.5  # Confidence threshold
+        yolo_model = None
+        if torch.cuda.is_available() and os.path.exists(YOLO_ENGINE_PATH):
+            # Deserialize the prebuilt TensorRT engine; YOLOv5's backend wrapper keeps
+            # the same Detections API and runs letterbox + NMS around the engine
+            logger.info(f"Loading YOLOv5 TensorRT engine from {YOLO_ENGINE_PATH}...")
+            yolo_model = torch.hub.load('ultralytics/yolov5', 'custom', path=YOLO_ENGINE_PATH, trust_repo=True)
+        elif not torch.cuda.is_available() and os.path.exists(YOLO_ONNX_PATH) and OnnxYoloModel.available():
+            logger.info(f"Loading YOLOv5 ONNX model from {YOLO_ONNX_PATH} (OpenVINO)...")
+            try:
+                yolo_model = OnnxYoloModel(YOLO_ONNX_PATH)
+            except Exception as e:
+                # A broken ONNX Runtime setup should cost speed, not detection
+                logger.warning(f"ONNX Runtime session failed, falling back to PyTorch on CPU: {e}")
+        
+        if yolo_model is None:
+            logger.info(f"Loading YOLOv5 model ({YOLO_WEIGHTS})...")
+            # Load YOLOv5 model from torch hub with trust_repo=True to avoid warning
+            yolo_model = torch.hub.load('ultralytics/yolov5', YOLO_WEIGHTS, pretrained=True, trust_repo=True).eval()
+            
+            # Keep the weights resident on the GPU whenever there is one, whatever the precision
+            if torch.cuda.is_available():
+                yolo_model = yolo_model.cuda()
+            
+            # Half precision only pays off with Tensor Cores (compute capability >= 7.0)
+            if torch.cuda.is_available() and torch.cuda.get_device_capability() >= (7, 0):
+                yolo_model.model.half()
+                yolo_fp16 = True
+                logger.info("YOLOv5 running in FP16 on CUDA")
+            
+            # NHWC lets cuDNN feed Tensor Cores without an implicit transpose per conv
+            if torch.cuda.is_available():
+                yolo_model.model.to(memory_format=torch.channels_last)
+                yolo_channels_last = True
+        yolo_model.conf = YOLO_CONF  # Confidence threshold
         yolo_model.iou = 0.45  # NMS IoU threshold
+        build_class_tables()
+        allocate_input_buffers()
+        compile_yolo_model()
         logger.info("YOLOv5 model loaded successfully")
         return True
     except Exception as e:
         logger.error(f"Failed to load YOLO model: {e}")
         logger.error("Falling back to color-based detection")
         yolo_model = None
+        yolo_fp16 = False
+        yolo_channels_last = False
         return False
 
-def process_with_yolo(image: np.ndarray, target_description: str):
-    """Process image with YOLO to detect target"""
+def allocate_input_buffers():
+    """Allocate the pinned host and device input buffers once per process"""
+    global input_host, input_device, input_copied
+    if not torch.cuda.is_available():
+        return
+    dtype = torch.float16 if yolo_fp16 else torch.float32
+    input_host = torch.empty((MAX_BATCH, 3, YOLO_INPUT_SIZE, YOLO_INPUT_SIZE), dtype=dtype, pin_memory=True)
+    # TensorRT bindings expect contiguous NCHW, so only the PyTorch model gets NHWC input
+    memory_format = torch.channels_last if yolo_channels_last else torch.contiguous_format
+    input_device = torch.empty_like(input_host, device="cuda", memory_format=memory_format)
+    input_copied = torch.cuda.Event()
+    input_copied.record()
+
+def compile_yolo_model():
+    """Optimize the PyTorch backbone (torch.compile or TorchScript) and pay the cost at startup"""
+    if not torch.cuda.is_available() or getattr(yolo_model.model, "engine", False) or YOLO_COMPILE == "none":
+        return  # Only the CUDA PyTorch model is compiled; TensorRT engines are already fused
+    
+    # Compilation is an optimization only: on any failure (no Triton or C compiler,
+    # unsupported GPU, untraceable model) keep serving with the eager model
+    backend = yolo_model.model
+    eager_model = backend.model
+    try:
+        if YOLO_COMPILE == "jit":
+            # Trace the inner DetectionModel so DetectMultiBackend keeps its dtype/layout
+            # handling; freezing folds conv+bn and inlines the weights as constants
+            logger.info("Tracing YOLOv5 backbone with TorchScript...")
+            with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=yolo_fp16):
+                input_device.zero_()
+                traced = torch.jit.trace(eager_model, input_device[:1], strict=False)
+            backend.model = torch.jit.freeze(traced.eval())
+        else:
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(os.path.dirname(__file__), ".inductor_cache"))
+            
+            # Default mode rather than "reduce-overhead": CUDA graphs would overwrite a batch's
+            # outputs on the next replay while callers are still running NMS on them
+            yolo_model.model = torch.compile(backend, fullgraph=False)
+        
+        logger.info("Compiling YOLOv5 backbone (warm-up)...")
+        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=yolo_fp16):
+            input_device.zero_()
+            # Single requests and full batches, so both are compiled before the first real request
+            # (TorchScript's profiling executor only optimizes a shape on its second run)
+            for batch_size in (1, MAX_BATCH):
+                for _ in range(2):
+                    yolo_model.model(input_device[:batch_size])
+        torch.cuda.synchronize()
+    except Exception as e:
+        logger.warning(f"YOLO_COMPILE={YOLO_COMPILE} failed, running the eager model: {e}")
+        backend.model = eager_model
+        yolo_model.model = backend
+
+def build_class_tables():
+    """Precompute target -> COCO class-ID sets from the loaded model's class names"""
+    CLASS_NAME_TO_ID.clear()
+    CLASS_NAME_TO_ID.update({name: class_id for class_id, name in yolo_model.names.items()})
+    TARGET_TO_IDS.clear()
+    TARGET_TO_IDS.update({
+        target: frozenset(CLASS_NAME_TO_ID[name] for name in classes if name in CLASS_NAME_TO_ID)
+        for target, classes in TARGET_TO_COCO.items()
+    })
+    target_class_ids.cache_clear()
+    class_id_tensor.cache_clear()
+
+@functools.lru_cache(maxsize=64)
+def target_class_ids(target_description: str) -> frozenset:
+    """COCO class IDs matching a target description"""
+    ids = frozenset()
+    for target, class_ids in TARGET_TO_IDS.items():
+        if target in target_description or any(word in target_description for word in target.split()):
+            ids |= class_ids
+    return ids
+
+@functools.lru_cache(maxsize=64)
+def class_id_tensor(class_ids: frozenset, device: torch.device) -> torch.Tensor:
+    """Class-ID set as a tensor on the detections' device, so filtering stays on-device"""
+    return torch.tensor(sorted(class_ids), dtype=torch.long, device=device)
+
+def use_gpu_decode(image_data: bytes) -> bool:
+    """Whether a frame can be decoded and preprocessed entirely on the GPU"""
+    # nvjpeg only handles JPEG, which is what the frontend streams
+    return yolo_model is not None and torch.cuda.is_available() and image_data[:2] == b"\xff\xd8"
+
+def decode_image_gpu(image_data: bytes) -> torch.Tensor:
+    """Decode JPEG bytes straight into a CHW uint8 CUDA tensor with nvjpeg"""
+    encoded = torch.frombuffer(image_data, dtype=torch.uint8)
+    return torchvision.io.decode_jpeg(encoded, mode=torchvision.io.ImageReadMode.RGB, device="cuda")
+
+def decode_frame(image_base64: str):
+    """Decode a base64 frame into a CHW uint8 CUDA tensor (nvjpeg) or an RGB numpy array"""
+    image_data = pybase64.b64decode(image_base64.rpartition(",")[2], validate=False)
+    if use_gpu_decode(image_data):
+        # Decode and letterbox on the GPU without a host round-trip
+        return decode_image_gpu(image_data)
+    
+    # Decode straight from the base64 bytes into a contiguous uint8 array
+    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image")
+    cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    return image
+
+def letterbox_params(height: int, width: int, size: int = YOLO_INPUT_SIZE):
+    """Scale, resized shape and padding that letterbox a frame into a size x size input"""
+    scale = min(size / height, size / width)
+    new_height, new_width = round(height * scale), round(width * scale)
+    return scale, new_height, new_width, (size - new_width) // 2, (size - new_height) // 2
+
+def letterbox_gpu(image: torch.Tensor, size: int = YOLO_INPUT_SIZE):
+    """Resize and pad a CHW uint8 CUDA tensor into a normalized 1x3xSxS model input"""
+    scale, new_height, new_width, pad_left, pad_top = letterbox_params(*image.shape[1:], size)
+    
+    x = F.interpolate(image[None].float(), size=(new_height, new_width), mode="bilinear", align_corners=False)
+    x = F.pad(x, (pad_left, size - new_width - pad_left, pad_top, size - new_height - pad_top), value=114.0)
+    return x / 255.0, scale, (pad_left, pad_top)
+
+def non_max_suppression(prediction: torch.Tensor, conf_threshold: float, iou_threshold: float) -> torch.Tensor:
+    """Minimal YOLOv5 NMS for one image: [A, 5 + classes] -> [N, 6] (xyxy, confidence, class)"""
+    prediction = prediction[prediction[:, 4] > conf_threshold]
+    scores, classes = (prediction[:, 5:] * prediction[:, 4:5]).max(1)
+    keep = scores > conf_threshold
+    prediction, scores, classes = prediction[keep], scores[keep], classes[keep]
+    
+    # xywh -> xyxy
+    boxes = torch.cat([prediction[:, :2] - prediction[:, 2:4] / 2, prediction[:, :2] + prediction[:, 2:4] / 2], 1)
+    keep = torchvision.ops.batched_nms(boxes, scores, classes, iou_threshold)
+    return torch.cat([boxes[keep], scores[keep, None], classes[keep, None].float()], 1)
+
+def scale_detections(detections: torch.Tensor, scale: float, pad_left: int, pad_top: int, width: int, height: int):
+    """Map letterboxed [N, 6] detections back to original image coordinates in place"""
+    detections[:, [0, 2]] = ((detections[:, [0, 2]] - pad_left) / scale).clamp(0, width)
+    detections[:, [1, 3]] = ((detections[:, [1, 3]] - pad_top) / scale).clamp(0, height)
+    return detections
+
+class OnnxYoloModel:
+    """YOLOv5 ONNX export run by ONNX Runtime, preferring the OpenVINO execution provider
+    
+    Mirrors the bits of the torch.hub AutoShape interface used here (names, conf, iou and
+    calling with an HWC frame to get results.xyxy), so it is a drop-in on CPU-only hosts.
+    """
+    
+    @staticmethod
+    def available() -> bool:
+        """Whether onnxruntime (ideally the onnxruntime-openvino build) is installed"""
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError:
+            return False
+        return True
+    
+    def __init__(self, path: str):
+        import onnxruntime as ort
+        
+        providers, provider_options = [], []
+        if "OpenVINOExecutionProvider" in ort.get_available_providers():
+            providers.append("OpenVINOExecutionProvider")
+            # The OpenVINO EP only supports FP32 (ACCURACY) precision on CPU
+            provider_options.append({"device_type": "CPU", "precision": "FP32"})
+        providers.append("CPUExecutionProvider")
+        provider_options.append({})
+        
+        self.session = ort.InferenceSession(path, providers=providers, provider_options=provider_options)
+        self.input_name = self.session.get_inputs()[0].name
+        # export.py stores the class names in the model metadata
+        self.names = ast.literal_eval(self.session.get_modelmeta().custom_metadata_map["names"])
+        self.conf = 0.25
+        self.iou = 0.45
+        logger.info(f"ONNX Runtime providers: {self.session.get_providers()}")
+    
+    def __call__(self, image: np.ndarray):
+        height, width = image.shape[:2]
+        scale, new_height, new_width, pad_left, pad_top = letterbox_params(height, width)
+        
+        x = np.full((YOLO_INPUT_SIZE, YOLO_INPUT_SIZE, 3), 114, dtype=np.uint8)
+        x[pad_top:pad_top + new_height, pad_left:pad_left + new_width] = cv2.resize(image, (new_width, new_height))
+        x = np.ascontiguousarray(x.transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+        
+        prediction = torch.from_numpy(self.session.run(None, {self.input_name: x})[0][0])
+        detections = non_max_suppression(prediction.float(), self.conf, self.iou)
+        return SimpleNamespace(xyxy=[scale_detections(detections, scale, pad_left, pad_top, width, height)])
+
+def max_batch_size() -> int:
+    """Largest batch the loaded backend accepts"""
+    backend = yolo_model.model
+    if getattr(backend, "engine", False) and not getattr(backend, "dynamic", False):
+        return 1  # Static TensorRT engines are built for a fixed batch of 1
+    return MAX_BATCH
+
+def to_model_input(image: np.ndarray, slot: int):
+    """Letterbox an HWC uint8 frame into pinned host slot `slot` without allocating new tensors"""
+    global resize_buffer
+    _, new_height, new_width, pad_left, pad_top = letterbox_params(*image.shape[:2])
+    
+    # Frames usually share one size, so the resize target is reused across requests
+    if resize_buffer is None or resize_buffer.shape[:2] != (new_height, new_width):
+        resize_buffer = np.empty((new_height, new_width, 3), dtype=np.uint8)
+    cv2.resize(image, (new_width, new_height), dst=resize_buffer, interpolation=cv2.INTER_LINEAR)
+    
+    # HWC uint8 -> normalized CHW written in place into the pinned buffer
+    host = input_host[slot]
+    host.fill_(114 / 255.0)
+    region = host[:, pad_top:pad_top + new_height, pad_left:pad_left + new_width]
+    region.copy_(torch.from_numpy(resize_buffer).permute(2, 0, 1))
+    region.div_(255.0)
+
+def run_batch(inputs: list) -> torch.Tensor:
+    """Stage inputs into the preallocated device buffer and run one forward pass"""
+    with torch.inference_mode():
+        # Host slots are only rewritten once the previous batch's DMA has finished
+        input_copied.synchronize()
+        for i, x in enumerate(inputs):
+            if isinstance(x, np.ndarray):
+                to_model_input(x, i)
+                input_device[i].copy_(input_host[i], non_blocking=True)
+            else:
+                input_device[i].copy_(x[0])
+        input_copied.record()
+        
+        with torch.autocast("cuda", dtype=torch.float16, enabled=yolo_fp16):
+            output = yolo_model.model(input_device[:len(inputs)])
+        prediction = output[0] if isinstance(output, (list, tuple)) else output
+        # TensorRT returns its persistent output bindings, which the next forward rewrites
+        # while callers may still be running NMS on this batch: hand out a private copy
+        return prediction.clone()
+
+def best_target_detection(detections: torch.Tensor, target_ids: frozenset):
+    """Highest-confidence detection among the target classes as a host list
+    [xmin, ymin, xmax, ymax, confidence, class], or None
+    
+    Copying the winning row back blocks until the GPU is done, so this runs in a worker thread.
+    """
+    if detections.shape[0] == 0:
+        return None
+    
+    # One O(N) reduction: non-target rows are masked to -1 rather than gathered out, so
+    # the only host sync is copying back the single winning row
+    is_target = torch.isin(detections[:, 5].long(), class_id_tensor(target_ids, detections.device))
+    best_score, best_index = torch.where(is_target, detections[:, 4], -1.0).max(0)
+    best_detection = torch.cat((detections[best_index], best_score[None])).tolist()
+    return best_detection[:6] if best_detection[6] >= 0 else None
+
+def detect_with_autoshape(image: np.ndarray, target_ids: frozenset):
+    """Run YOLOv5's own letterbox/inference/NMS pipeline on an HWC numpy frame"""
+    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=yolo_fp16):
+        return best_target_detection(yolo_model(image).xyxy[0], target_ids)
+
+def finish_gpu_detection(prediction: torch.Tensor, letterbox: tuple, target_ids: frozenset):
+    """NMS, letterbox undo and target pick for one batched prediction
+    
+    NMS and the final copy synchronize with the GPU, so this runs in a worker thread to
+    keep the event loop (and the micro-batcher's collection window) free.
+    """
+    scale, pad_left, pad_top, width, height = letterbox
+    with torch.inference_mode():
+        detections = non_max_suppression(prediction.float(), yolo_model.conf, yolo_model.iou)
+        
+        # Undo letterbox padding and scaling
+        detections = scale_detections(detections, scale, pad_left, pad_top, width, height)
+        return best_target_detection(detections, target_ids)
+
+async def batch_worker():
+    """Group pending GPU inputs into one forward pass and resolve each caller's future"""
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await batch_queue.get()]
+        deadline = loop.time() + MAX_WAIT
+        while len(items) < max_batch_size():
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            # Staging and kernel launches run off the event loop thread
+            prediction = await asyncio.to_thread(run_batch, [x for x, _ in items])
+            for i, (_, future) in enumerate(items):
+                if not future.done():
+                    future.set_result(prediction[i])
+        except Exception as e:
+            logger.error(f"Batched YOLO inference failed: {e}")
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+
+async def detect_on_gpu(image, target_ids: frozenset):
+    """Run YOLO on the GPU, returning the best target detection in image coordinates (or None)
+    
+    image is either a CHW uint8 CUDA tensor (letterboxed here on the device) or an HWC
+    numpy array (letterboxed by the batch worker into the pinned input buffer).
+    """
+    if isinstance(image, torch.Tensor):
+        height, width = image.shape[1:]
+        with torch.inference_mode():
+            x, scale, (pad_left, pad_top) = letterbox_gpu(image)
+    else:
+        height, width = image.shape[:2]
+        scale, _, _, pad_left, pad_top = letterbox_params(height, width)
+        x = image
+    
+    # Hand the input to the micro-batcher and wait for this request's prediction
+    future = asyncio.get_running_loop().create_future()
+    await batch_queue.put((x, future))
+    prediction = await future
+    
+    return await asyncio.to_thread(
+        finish_gpu_detection, prediction, (scale, pad_left, pad_top, width, height), target_ids
+    )
+
+async def process_with_yolo(image, target_description: str):
+    """Process image with YOLO to detect target
+    
+    image is either an HWC numpy array or a CHW uint8 CUDA tensor from decode_image_gpu.
+    """
     global yolo_model
     
     if yolo_model is None:
         logger.error("YOLO model not loaded")
         return None, None, 0.0
     
-    # Map target descriptions to COCO classes
-    # COCO class names: https://github.com/ultralytics/yolov5/blob/master/data/coco.yaml
-    target_to_coco = {
-        # Basic shapes - map to similar COCO classes
-        "Red Cube": ["tv", "remote", "book"],  # Box-like objects
-        "Pink Sphere": ["sports ball", "orange", "apple"],  # Round objects
-        "Green Cone": ["traffic light", "bottle", "vase"],  # Cone-like objects
-        "Yellow Cylinder": ["bottle", "cup", "vase"],  # Cylinder-like objects
-        "Skeleton Head": ["person", "teddy bear", "clock"],  # Person-like or head-like
-        
-        # Also check for partial matches
-        "Cube": ["tv", "remote", "book"],
-        "Sphere": ["sports ball", "orange", "apple"],
-        "Cone": ["traffic light", "bottle", "vase"],
-        "Cylinder": ["bottle", "cup", "vase"],
-        "Pyramid": ["orange", "apple", "sports ball"],
-        "Skeleton": ["person", "teddy bear", "clock"],
-        "Head": ["person", "teddy bear", "clock"],
-    }
-    
-    # Find matching COCO classes for target description
-    target_classes = []
-    for target, classes in target_to_coco.items():
-        if target in target_description or any(word in target_description for word in target.split()):
-            target_classes.extend(classes)
-    
-    # Remove duplicates
-    target_classes = list(set(target_classes))
+    # Look up the (cached) COCO class IDs for this target
+    target_ids = target_class_ids(target_description)
     
-    if not target_classes:
+    if not target_ids:
         logger.warning(f"No COCO class mapping found for target: {target_description}")
         return None, None, 0.0
     
-    # Run YOLO inference
-    results = yolo_model(image)
-    
-    # Parse results
-    detections = results.pandas().xyxy[0]  # DataFrame with columns: xmin, ymin, xmax, ymax, confidence, class, name
-    
-    # Filter detections for target classes
-    target_detections = detections[detections['name'].isin(target_classes)]
+    # Run YOLO inference and pick the best target detection off the event loop;
+    # best_detection is [xmin, ymin, xmax, ymax, confidence, class]
+    if batch_queue is not None:
+        best_detection = await detect_on_gpu(image, target_ids)
+        height, width = image.shape[1:] if isinstance(image, torch.Tensor) else image.shape[:2]
+    else:
+        best_detection = await asyncio.to_thread(detect_with_autoshape, image, target_ids)
+        height, width = image.shape[:2]
     
-    if target_detections.empty:
+    if best_detection is None:
         return None, None, 0.0
     
-    # Get the detection with highest confidence
-    best_detection = target_detections.iloc[target_detections['confidence'].idxmax()]
-    
     # Extract bounding box and confidence
-    xmin = int(best_detection['xmin'])
-    ymin = int(best_detection['ymin'])
-    xmax = int(best_detection['xmax'])
-    ymax = int(best_detection['ymax'])
-    confidence = float(best_detection['confidence'])
-    
-    height, width = image.shape[:2]
+    xmin, ymin, xmax, ymax = (int(v) for v in best_detection[:4])
+    confidence = float(best_detection[4])
+    class_name = yolo_model.names[int(best_detection[5])]
     
     # Convert to required format [ymin, xmin, ymax, xmax] scaled 0-1000
     ymin_scaled = int((ymin / height) * 1000)
@@ -146,59 +573,78 @@ def process_with_yolo(image: np.ndarray, target_description: str):
     bbox_height = ymax_scaled - ymin_scaled
     
     # Adjust confidence based on position (more centered = higher confidence)
-    distance_from_center = np.sqrt((center_x_scaled - 500)**2 + (center_y_scaled - 500)**2)
-    max_distance = np.sqrt(500**2 + 500**2)
-    position_confidence = 1.0 - (distance_from_center / max_distance)
+    distance_from_center = math.hypot(center_x_scaled - 500, center_y_scaled - 500)
+    position_confidence = 1.0 - (distance_from_center / MAX_SCALED_DISTANCE)
     
     # Combine YOLO confidence with position confidence
     final_confidence = (confidence * 0.7 + position_confidence * 0.3)
     
-    logger.info(f"YOLO detection: target={target_description}, class={best_detection['name']}, confidence={final_confidence:.2f}")
+    logger.info(f"YOLO detection: target={target_description}, class={class_name}, confidence={final_confidence:.2f}")
     
     return bounding_box, (center_x_scaled, center_y_scaled, bbox_height), final_confidence
 
+def frame_hash(image) -> int:
+    """Cheap perceptual hash: xxh64 over a 32x32 downsample of the frame"""
+    if isinstance(image, torch.Tensor):
+        # Downsample on the GPU so only 3 KB crosses back to the host
+        thumbnail = F.interpolate(image[None].float(), size=(32, 32), mode="area").to(torch.uint8).cpu().numpy()
+    else:
+        thumbnail = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA)
+    return xxhash.xxh64(thumbnail.tobytes()).intdigest()
+
+async def process_with_yolo_cached(image, target_description: str):
+    """Run YOLO detection, reusing the result for duplicate/near-duplicate frames"""
+    global detection_cache_cleared_at
+    
+    # Invalidate periodically so a slowly changing scene is re-detected
+    now = time.monotonic()
+    if now - detection_cache_cleared_at > DETECTION_CACHE_TTL:
+        detection_cache.clear()
+        detection_cache_cleared_at = now
+    
+    # Hashing a CUDA frame copies its thumbnail back (a GPU sync), so do it off the event loop
+    image_hash = await asyncio.to_thread(frame_hash, image) if isinstance(image, torch.Tensor) else frame_hash(image)
+    key = (image_hash, target_description)
+    if key in detection_cache:
+        detection_cache.move_to_end(key)
+        return detection_cache[key]
+    
+    result = await process_with_yolo(image, target_description)
+    detection_cache[key] = result
+    if len(detection_cache) > DETECTION_CACHE_SIZE:
+        detection_cache.popitem(last=False)
+    return result
+
+# Distance from the center to a corner on the 0-1000 scale
+MAX_SCALED_DISTANCE = math.hypot(500, 500)
+
+@functools.lru_cache(maxsize=16)
+def max_center_distance(width: int, height: int) -> float:
+    """Distance from the image center to a corner, cached per frame size"""
+    return math.hypot(width / 2, height / 2)
+
 def process_with_color(image: np.ndarray, target_description: str):
     """Fallback color-based detection when YOLO fails"""
-    # Convert to HSV for color detection
-    hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-    
-    # Define color ranges for different targets
-    # Optimized ranges for better detection of all shapes
-    color_ranges = {
-        "Red Cube": ([0, 120, 70], [10, 255, 255]),  # Bright red
-        "Pink Sphere": ([150, 70, 70], [170, 255, 255]),  # Pink/Magenta
-        "Green Cone": ([40, 80, 80], [80, 255, 255]),  # Bright green
-        "Yellow Cylinder": ([20, 100, 100], [30, 255, 255]),  # Bright yellow
-        "Skeleton Head": ([0, 0, 180], [180, 40, 255]),  # Very light/white
-    }
-    
     # Also check for partial matches (e.g., "Pyramid" in "Orange Pyramid")
-    target_color = None
-    for target, (lower, upper) in color_ranges.items():
-        if target in target_description or any(word in target_description for word in target.split()):
-            target_color = (np.array(lower), np.array(upper))
-            break
+    target_index = next(
+        (i for i, target in enumerate(COLOR_TARGETS)
+         if target in target_description or any(word in target_description for word in target.split())),
+        None,
+    )
     
-    if target_color is None:
+    if target_index is None:
         return None, None, 0.0
     
     # Create mask for target color
-    lower, upper = target_color
-    mask = cv2.inRange(hsv, lower, upper)
-    
-    # Find contours
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+    mask = cv2.inRange(hsv, COLOR_LOWERS[target_index], COLOR_UPPERS[target_index])
+    x, y, w, h, contour_area = largest_component_bbox(mask)
     
-    if not contours:
+    if contour_area == 0:
         return None, None, 0.0
     
-    # Get largest contour
-    largest_contour = max(contours, key=cv2.contourArea)
-    x, y, w, h = cv2.boundingRect(largest_contour)
-    
-    # Calculate confidence based on contour area and position
+    # Calculate confidence based on blob area and position
     height, width = image.shape[:2]
-    contour_area = cv2.contourArea(largest_contour)
     max_possible_area = height * width
     
     # Area confidence: target should be reasonably sized
@@ -208,9 +654,8 @@ def process_with_color(image: np.ndarray, target_description: str):
     # Position confidence: more centered = higher confidence
     center_x = x + w/2
     center_y = y + h/2
-    distance_from_center = np.sqrt((center_x - width/2)**2 + (center_y - height/2)**2)
-    max_distance = np.sqrt((width/2)**2 + (height/2)**2)
-    position_confidence = 1.0 - (distance_from_center / max_distance)
+    distance_from_center = math.hypot(center_x - width/2, center_y - height/2)
+    position_confidence = 1.0 - (distance_from_center / max_center_distance(width, height))
     
     # Combined confidence
     confidence = (area_confidence * 0.6 + position_confidence * 0.4) * 1.5
@@ -238,49 +683,76 @@ def process_with_color(image: np.ndarray, target_description: str):
     
     return bounding_box, (center_x_scaled, center_y_scaled, bbox_height), confidence
 
-def determine_action(center_x, center_y, bbox_height, target_visible):
-    """Simple navigation that always moves forward for distant targets"""
-    
-    if not target_visible:
-        # Always move forward when target not visible
-        return "FORWARD", "Target not visible. Moving forward to explore."
-    
-    # TARGET IS VISIBLE
-    
+# Navigation outcomes for a visible target: (action, reasoning template)
+NAVIGATION_BRANCHES = [
     # If target is extremely small (height < 50), ALWAYS move forward
-    # Don't even check position - just get closer
-    if bbox_height < 50:
-        return "FORWARD", f"Target VERY far away (height={bbox_height:.0f}). Moving forward urgently!"
-    
+    ("FORWARD", "Target VERY far away (height={height:.0f}). Moving forward urgently!"),
     # If target is very small (50-150), move forward unless at extreme edges
+    ("LEFT", "Target far away at super left X={x:.0f}. Quick LEFT turn."),
+    ("RIGHT", "Target far away at super right X={x:.0f}. Quick RIGHT turn."),
+    ("FORWARD", "Target far away (height={height:.0f}). Moving forward!"),
+    # For small/medium targets (150-400), normal navigation
+    ("LEFT", "Target at left edge X={x:.0f}. Turning LEFT. (height={height:.0f})"),
+    ("RIGHT", "Target at right edge X={x:.0f}. Turning RIGHT. (height={height:.0f})"),
+    ("FORWARD", "Target visible at X={x:.0f}. Moving FORWARD. (height={height:.0f})"),
+    # For larger targets (closer), precise navigation
+    ("LEFT", "Target at X={x:.0f}. Turning LEFT. (height={height:.0f})"),
+    ("RIGHT", "Target at X={x:.0f}. Turning RIGHT. (height={height:.0f})"),
+    ("FORWARD", "Target centered at X={x:.0f}. Moving FORWARD. (height={height:.0f})"),
+    ("STOP", "Target reached! Centered at X={x:.0f}, height={height:.0f}"),
+]
+
+def navigation_branch(center_x, bbox_height):
+    """Index into NAVIGATION_BRANCHES for a visible target (used to build ACTION_TABLE)"""
+    if bbox_height < 50:
+        return 0
     elif bbox_height < 150:
         if center_x < 50:  # Super extreme left
-            return "LEFT", f"Target far away at super left X={center_x:.0f}. Quick LEFT turn."
+            return 1
         elif center_x > 950:  # Super extreme right
-            return "RIGHT", f"Target far away at super right X={center_x:.0f}. Quick RIGHT turn."
-        else:
-            return "FORWARD", f"Target far away (height={bbox_height:.0f}). Moving forward!"
-    
-    # For small/medium targets (150-400), normal navigation
+            return 2
+        return 3
     elif bbox_height < 400:
         if center_x < 200:
-            return "LEFT", f"Target at left edge X={center_x:.0f}. Turning LEFT. (height={bbox_height:.0f})"
+            return 4
         elif center_x > 800:
-            return "RIGHT", f"Target at right edge X={center_x:.0f}. Turning RIGHT. (height={bbox_height:.0f})"
-        else:
-            return "FORWARD", f"Target visible at X={center_x:.0f}. Moving FORWARD. (height={bbox_height:.0f})"
-    
-    # For larger targets (closer), precise navigation
+            return 5
+        return 6
     else:
         if center_x < 300:
-            return "LEFT", f"Target at X={center_x:.0f}. Turning LEFT. (height={bbox_height:.0f})"
+            return 7
         elif center_x > 700:
-            return "RIGHT", f"Target at X={center_x:.0f}. Turning RIGHT. (height={bbox_height:.0f})"
-        else:
-            if bbox_height < 800:
-                return "FORWARD", f"Target centered at X={center_x:.0f}. Moving FORWARD. (height={bbox_height:.0f})"
-            else:
-                return "STOP", f"Target reached! Centered at X={center_x:.0f}, height={bbox_height:.0f}"
+            return 8
+        return 9 if bbox_height < 800 else 10
+
+# All navigation thresholds are multiples of QUANT_STEP on the 0-1000 scale. Even bins
+# hold exact multiples and odd bins the open interval above them, so every < / >
+# comparison is constant within a bin and the table matches the branches exactly.
+QUANT_STEP = 50
+QUANT_BINS = 2 * 1000 // QUANT_STEP + 1
+
+def quantize(value):
+    """Bin a 0-1000 coordinate for ACTION_TABLE lookups"""
+    step, remainder = divmod(value, QUANT_STEP)
+    return min(max(int(2 * step + (remainder != 0)), 0), QUANT_BINS - 1)
+
+ACTION_TABLE = np.empty((QUANT_BINS, QUANT_BINS), dtype=np.uint8)
+for height_bin in range(QUANT_BINS):
+    for x_bin in range(QUANT_BINS):
+        # Representative value: the multiple itself, or the midpoint of the interval above it
+        ACTION_TABLE[height_bin, x_bin] = navigation_branch(
+            x_bin * QUANT_STEP / 2, height_bin * QUANT_STEP / 2
+        )
+
+def determine_action(center_x, center_y, bbox_height, target_visible):
+    """Simple navigation that always moves forward for distant targets"""
+    
+    if not target_visible:
+        # Always move forward when target not visible
+        return "FORWARD", "Target not visible. Moving forward to explore."
+    
+    action, reasoning = NAVIGATION_BRANCHES[ACTION_TABLE[quantize(bbox_height), quantize(center_x)]]
+    return action, reasoning.format(x=center_x, height=bbox_height)
 
 # Remove old startup event - using lifespan handler instead
 
@@ -290,23 +762,22 @@ async def root():
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "model_loaded": yolo_model is not None}
+    return {"status": "healthy", "model_loaded": yolo_model is not None, "stereo_vision": True, "detector": DETECTOR}
 
-@app.post("/api/vision", response_model=VisionResponse)
 async def process_vision(request: VisionRequest):
     """Process image and return navigation command"""
     try:
-        # Decode base64 image
-        image_data = base64.b64decode(request.image_base64.split(",")[-1])
-        image = Image.open(io.BytesIO(image_data))
-        image_np = np.array(image)
+        # Decode base64 image in a worker thread so other requests keep being served
+        image = await asyncio.to_thread(decode_frame, request.image_base64)
         
         # Try YOLO first, fall back to color detection if YOLO not loaded
         if yolo_model is not None:
-            bounding_box, target_info, confidence = process_with_yolo(image_np, request.target_description)
+            bounding_box, target_info, confidence = await process_with_yolo_cached(image, request.target_description)
             detection_method = "YOLO"
         else:
-            bounding_box, target_info, confidence = process_with_color(image_np, request.target_description)
+            bounding_box, target_info, confidence = await asyncio.to_thread(
+                process_with_color, image, request.target_description
+            )
             detection_method = "Color"
         
         target_visible = bounding_box is not None
@@ -334,6 +805,12 @@ async def process_vision(request: VisionRequest):
         logger.error(f"Error processing vision request: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Single /api/vision route, backed by the configured detector
+if DETECTOR == "stereo":
+    app.post("/api/vision", response_model=StereoVisionResponse)(process_vision_stereo)
+else:
+    app.post("/api/vision", response_model=VisionResponse)(process_vision)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,15 +1,13 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional, List
+import asyncio
 import base64
-import io
-from PIL import Image
+import cv2
 import numpy as np
 import logging
-import torch
-import cv2
+import os
+import threading
 
 from stereo_vision import StereoVision, get_color_range
 
@@ -17,25 +15,8 @@ from stereo_vision import StereoVision, get_color_range
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Lifespan event handler for YOLO model loading
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Startup: load YOLO model
-    load_yolo_model()
-    yield
-    # Shutdown: cleanup if needed
-    pass
-
-app = FastAPI(title="Stereo Vision Backend for NeuroSeeker", version="2.0.0", lifespan=lifespan)
-
-# Configure CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000", "http://localhost:5173"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Stereo endpoints, mounted on the single app in main.py
+router = APIRouter()
 
 # Request/Response models
 class StereoVisionRequest(BaseModel):
@@ -53,31 +34,29 @@ class VisionResponse(BaseModel):
     angle: Optional[float] = None  # Angle to target in degrees
 
 # Global variables
-yolo_model = None
-stereo_vision = StereoVision(baseline_cm=10.0, fov_degrees=110.0)
-
-def load_yolo_model():
-    """Load YOLO model on startup"""
-    global yolo_model
-    try:
-        logger.info("Loading YOLOv5 model...")
-        # Load YOLOv5 model from torch hub with trust_repo=True to avoid warning
-        yolo_model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True, trust_repo=True)
-        yolo_model.conf = 0.5  # Confidence threshold
-        yolo_model.iou = 0.45  # NMS IoU threshold
-        logger.info("YOLOv5 model loaded successfully")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to load YOLO model: {e}")
-        logger.error("Falling back to stereo color detection")
-        yolo_model = None
-        return False
+# main.py always imports this router, so the matcher pool and kernel warm-up are
+# only paid once a stereo endpoint (or DETECTOR=stereo) actually needs them
+_stereo_vision = None
+_stereo_vision_lock = threading.Lock()
+
+def get_stereo_vision() -> StereoVision:
+    """Return the shared StereoVision, building it on first use"""
+    global _stereo_vision
+    with _stereo_vision_lock:
+        if _stereo_vision is None:
+            _stereo_vision = StereoVision(baseline_cm=10.0, fov_degrees=110.0)
+    return _stereo_vision
 
 def decode_image(base64_str: str) -> np.ndarray:
-    """Decode base64 image string to numpy array"""
-    image_data = base64.b64decode(base64_str.split(",")[-1])
-    image = Image.open(io.BytesIO(image_data))
-    return np.array(image)
+    """Decode base64 image string to an RGB numpy array"""
+    # Strip any data-URI prefix without splitting the whole payload into a list
+    image_data = base64.b64decode(base64_str.rpartition(",")[2])
+    # libjpeg-turbo decode straight from the bytes, then swap BGR -> RGB in place
+    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image")
+    cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    return image
 
 def process_with_stereo_vision(left_image: np.ndarray, right_image: np.ndarray, target_description: str):
     """Process stereo images to detect target with depth information"""
@@ -88,22 +67,20 @@ def process_with_stereo_vision(left_image: np.ndarray, right_image: np.ndarray,
         logger.warning(f"No color range found for target: {target_description}")
         return None, None, None, 0.0
     
-    # Detect target with depth
-    distance, angle, confidence = stereo_vision.detect_target_with_depth(
+    # Detect target with depth (also returns the color bounding box, so the
+    # HSV conversion / mask / contour pass is not repeated here)
+    distance, angle, confidence, bbox = get_stereo_vision().detect_target_with_depth(
         left_image, right_image, hsv_low, hsv_high
     )
     
-    if distance is None or angle is None:
+    # Monocular requests never get a distance; keep their bbox so the caller
+    # can fall back to bounding-box navigation
+    monocular = left_image is right_image
+    if angle is None or (distance is None and not monocular):
         return None, None, None, confidence or 0.0
     
-    # Calculate bounding box from color detection
-    left_hsv = cv2.cvtColor(left_image, cv2.COLOR_RGB2HSV)
-    mask = cv2.inRange(left_hsv, hsv_low, hsv_high)
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    if contours:
-        largest_contour = max(contours, key=cv2.contourArea)
-        x, y, w, h = cv2.boundingRect(largest_contour)
+    if bbox is not None:
+        x, y, w, h = bbox
         
         # Convert to required format [ymin, xmin, ymax, xmax] scaled 0-1000
         height, width = left_image.shape[:2]
@@ -121,36 +98,30 @@ def process_with_stereo_vision(left_image: np.ndarray, right_image: np.ndarray,
         
         target_info = (center_x, center_y, bbox_height)
         
-        logger.info(f"Stereo detection: target={target_description}, distance={distance:.1f}m, angle={angle:.1f}°, confidence={confidence:.2f}")
+        logger.info(f"Stereo detection: target={target_description}, distance={distance}, angle={angle:.1f}°, confidence={confidence:.2f}")
         
         return bounding_box, target_info, (distance, angle), confidence
     
     return None, None, (distance, angle), confidence
 
-@app.get("/")
-async def root():
-    return {"message": "Stereo Vision Backend for NeuroSeeker", "status": "running", "stereo": True}
-
-@app.get("/health")
-async def health():
-    return {"status": "healthy", "model_loaded": yolo_model is not None, "stereo_vision": True}
-
 # For backward compatibility with existing frontend
 class VisionRequest(BaseModel):
     image_base64: str
     target_description: str
 
-@app.post("/api/stereo_vision", response_model=VisionResponse)
+@router.post("/api/stereo_vision", response_model=VisionResponse)
 async def process_stereo_vision(request: StereoVisionRequest):
     """Process stereo images and return navigation command with depth information"""
     try:
-        # Decode stereo images
-        left_image = decode_image(request.left_image_base64)
-        right_image = decode_image(request.right_image_base64)
+        # Decode stereo images concurrently (imdecode releases the GIL)
+        left_image, right_image = await asyncio.gather(
+            asyncio.to_thread(decode_image, request.left_image_base64),
+            asyncio.to_thread(decode_image, request.right_image_base64)
+        )
         
         # Process with stereo vision
-        bounding_box, target_info, depth_info, confidence = process_with_stereo_vision(
-            left_image, right_image, request.target_description
+        bounding_box, target_info, depth_info, confidence = await asyncio.to_thread(
+            process_with_stereo_vision, left_image, right_image, request.target_description
         )
         
         target_visible = bounding_box is not None
@@ -160,7 +131,7 @@ async def process_stereo_vision(request: StereoVisionRequest):
             distance, angle = depth_info
             
             # Get navigation command based on depth and angle
-            action, reasoning = stereo_vision.get_navigation_command(distance, angle, confidence)
+            action, reasoning = get_stereo_vision().get_navigation_command(distance, angle, confidence)
         else:
             action, reasoning = "SCAN", "Target not visible. Scanning..."
             bounding_box = []
@@ -185,17 +156,17 @@ async def process_stereo_vision(request: StereoVisionRequest):
         logger.error(f"Error processing stereo vision request: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/vision", response_model=VisionResponse)
+# Registered as /api/vision by main.py when DETECTOR=stereo
 async def process_vision(request: VisionRequest):
     """Process single image (for backward compatibility)"""
     try:
         # Decode single image
-        image = decode_image(request.image_base64)
+        image = await asyncio.to_thread(decode_image, request.image_base64)
         
         # Use the image as both left and right (monocular fallback)
         # This won't give accurate depth but maintains compatibility
-        bounding_box, target_info, depth_info, confidence = process_with_stereo_vision(
-            image, image, request.target_description  # Same image for both
+        bounding_box, target_info, depth_info, confidence = await asyncio.to_thread(
+            process_with_stereo_vision, image, image, request.target_description  # Same image for both
         )
         
         target_visible = bounding_box is not None
@@ -219,7 +190,7 @@ async def process_vision(request: VisionRequest):
                         action, reasoning = "STOP", f"Target reached! Centered at X={center_x:.0f}"
             else:
                 # Use stereo navigation
-                action, reasoning = stereo_vision.get_navigation_command(distance, angle, confidence)
+                action, reasoning = get_stereo_vision().get_navigation_command(distance, angle, confidence)
         else:
             action, reasoning = "SCAN", "Target not visible. Scanning..."
             bounding_box = []
@@ -245,5 +216,9 @@ async def process_vision(request: VisionRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
+    # The stereo endpoints are served by the single app in main.py; running this
+    # module keeps its old meaning of serving /api/vision with the stereo pipeline
     import uvicorn
+    os.environ.setdefault("DETECTOR", "stereo")
+    from main import app
     uvicorn.run(app, host="0.0.0.0", port=8000)
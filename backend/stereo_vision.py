@@ -1,10 +1,85 @@
+import bisect
+import contextlib
 import cv2
+import functools
 import numpy as np
 from typing import Tuple, Optional
 import logging
+import os
+import queue
+
+from stereo_kernels import disp_to_depth_stats
 
 logger = logging.getLogger(__name__)
 
+# Compile the Numba kernel (or load it from the on-disk cache) at import instead of
+# on the first request. This also starts Numba's thread pool on the importing thread:
+# StereoVision is built lazily from whichever thread first needs it, and a TBB pool
+# first started from a worker thread hangs interpreter shutdown.
+_window = (0, 1, 0, 1)
+disp_to_depth_stats(np.zeros((1, 1), np.int16), 1.0, np.empty((1, 1), np.float32), _window, _window)
+
+# Upper bound on concurrent CPU stereo matchers (each holds its own scratch buffers)
+STEREO_MATCHER_POOL_SIZE = int(os.getenv("STEREO_MATCHER_POOL_SIZE", "4"))
+
+# Try plain block matching first on the CPU; only rerun SGBM when the target's
+# depth is too inconsistent to trust (std in meters)
+STEREO_FAST_MATCHER = os.getenv("STEREO_FAST_MATCHER", "1") == "1"
+FAST_MATCHER_MAX_DEPTH_STD = 2.5
+
+# Disparity search range of every matcher (pixels, multiple of 16)
+NUM_DISPARITIES = 64
+# Extra pixels kept around the target ROI so matching windows and SGBM paths
+# see some context beyond the bbox
+ROI_MARGIN = 16
+# Narrowest ROI the matchers accept: the search range plus the largest matching
+# block (StereoBM's 15) and a margin on both sides
+MIN_ROI_WIDTH = NUM_DISPARITIES + 2 * ROI_MARGIN
+
+# Navigation distance bands (meters): very close, medium, far away
+NAVIGATION_DISTANCE_BANDS = (1.0, 5.0)
+# Per band: |normalized angle| below which the target counts as centered, and the
+# normalized angle beyond which it is off to one side
+NAVIGATION_ANGLE_THRESHOLDS = ((0.1, 0.3), (0.2, 0.5), (0.3, 0.7))
+# Per band, (action, reasoning template) for zones: in between, left, centered, right
+NAVIGATION_TABLE = (
+    (  # Very close
+        ("FORWARD", "Target close at {distance:.1f}m, moving FORWARD"),
+        ("LEFT", "Target close at {distance:.1f}m, turning LEFT (angle: {angle:.1f}°)"),
+        ("STOP", "Target reached! Distance: {distance:.1f}m, Angle: {angle:.1f}°"),
+        ("RIGHT", "Target close at {distance:.1f}m, turning RIGHT (angle: {angle:.1f}°)"),
+    ),
+    (  # Medium distance
+        ("FORWARD", "Target at {distance:.1f}m, moving FORWARD while centering"),
+        ("LEFT", "Target at {distance:.1f}m, turning LEFT to center"),
+        ("FORWARD", "Target at medium distance {distance:.1f}m, moving FORWARD"),
+        ("RIGHT", "Target at {distance:.1f}m, turning RIGHT to center"),
+    ),
+    (  # Far away
+        ("FORWARD", "Target far at {distance:.1f}m, moving FORWARD to close distance"),
+        ("LEFT", "Target far at {distance:.1f}m, turning LEFT to find"),
+        ("FORWARD", "Target far away at {distance:.1f}m, moving FORWARD urgently"),
+        ("RIGHT", "Target far at {distance:.1f}m, turning RIGHT to find"),
+    ),
+)
+
+class StereoWorker:
+    """One (accurate, fast) matcher pair plus the scratch buffers its requests reuse"""
+    
+    def __init__(self, accurate, fast, capacity: int):
+        self.accurate = accurate
+        self.fast = fast
+        self._capacity = capacity
+        self._buffers = {}
+    
+    def buffer(self, name: str, shape: Tuple[int, int], dtype) -> np.ndarray:
+        """Contiguous scratch array for one request; the allocation persists and only grows"""
+        size = shape[0] * shape[1]
+        flat = self._buffers.get(name)
+        if flat is None or flat.size < size:
+            flat = self._buffers[name] = np.empty(max(size, self._capacity), dtype)
+        return flat[:size].reshape(shape)
+
 class StereoVision:
     """Stereo vision system for depth estimation with 110° FOV"""
     
@@ -27,10 +102,43 @@ class StereoVision:
         # f = (width/2) / tan(FOV/2)
         self.focal_length = (self.image_width / 2) / np.tan(self.fov / 2)
         
-        # Stereo matcher for depth estimation
-        self.stereo = cv2.StereoSGBM_create(
+        # Stereo matcher for depth estimation: CUDA semi-global matching when OpenCV was
+        # built with CUDA, otherwise SGBM on the CPU
+        self.use_cuda = hasattr(cv2, "cuda") and cv2.cuda.getCudaEnabledDeviceCount() > 0
+        if self.use_cuda:
+            # Persistent device buffers, reused every frame instead of reallocated
+            self._d_left = cv2.cuda_GpuMat()
+            self._d_right = cv2.cuda_GpuMat()
+            self._d_disparity = cv2.cuda_GpuMat()
+        
+        # StereoBM fast path (CPU only; CUDA SGM is already fast)
+        self.use_fast_matcher = STEREO_FAST_MATCHER and not self.use_cuda
+        
+        # Matchers keep internal scratch buffers, so compute() is not thread-safe:
+        # each request checks a worker (matcher pair + host buffers) out of the pool.
+        # The CUDA path has a single worker because the device buffers above are shared too.
+        pool_size = 1 if self.use_cuda else min(STEREO_MATCHER_POOL_SIZE, os.cpu_count() or 1)
+        self._matcher_pool = queue.Queue()
+        for _ in range(pool_size):
+            self._matcher_pool.put(StereoWorker(*self._create_matcher(), self.image_width * self.image_height))
+        
+        logger.info(f"Stereo Vision initialized: baseline={self.baseline}m, FOV={fov_degrees}°, focal={self.focal_length:.1f}px, cuda={self.use_cuda}, fast={self.use_fast_matcher}, matchers={pool_size}")
+    
+    def _create_matcher(self):
+        """Create one (accurate, fast) stereo matcher pair for the configured backend"""
+        if self.use_cuda:
+            return cv2.cuda.createStereoSGM(
+                minDisparity=0,
+                numDisparities=NUM_DISPARITIES,
+                P1=10,
+                P2=120,
+                uniquenessRatio=10,
+                mode=cv2.STEREO_SGBM_MODE_HH4
+            ), None
+        fast = cv2.StereoBM_create(numDisparities=NUM_DISPARITIES, blockSize=15) if self.use_fast_matcher else None
+        return cv2.StereoSGBM_create(
             minDisparity=0,
-            numDisparities=64,  # Reduced for performance
+            numDisparities=NUM_DISPARITIES,  # Reduced for performance
             blockSize=11,
             P1=8 * 3 * 11**2,
             P2=32 * 3 * 11**2,
@@ -39,9 +147,38 @@ class StereoVision:
             speckleWindowSize=100,
             speckleRange=32,
             mode=cv2.STEREO_SGBM_MODE_SGBM_3WAY
-        )
+        ), fast
+    
+    @contextlib.contextmanager
+    def checkout(self):
+        """Borrow a worker from the pool; arrays from its buffers are only valid inside the block"""
+        worker = self._matcher_pool.get()
+        try:
+            yield worker
+        finally:
+            self._matcher_pool.put(worker)
+    
+    def compute_raw_disparity(self,
+                              left_gray: np.ndarray,
+                              right_gray: np.ndarray,
+                              fast: bool,
+                              worker: StereoWorker) -> np.ndarray:
+        """
+        Run the worker's matcher and return its int16 disparity (4 fractional bits)
         
-        logger.info(f"Stereo Vision initialized: baseline={self.baseline}m, FOV={fov_degrees}°, focal={self.focal_length:.1f}px")
+        Args:
+            left_gray: Left camera image (grayscale)
+            right_gray: Right camera image (grayscale)
+            fast: Use StereoBM instead of SGBM when it is enabled
+            worker: Checked-out worker whose buffers receive the result
+        """
+        matcher = worker.fast if fast and worker.fast is not None else worker.accurate
+        if self.use_cuda:
+            self._d_left.upload(left_gray)
+            self._d_right.upload(right_gray)
+            self._d_disparity = matcher.compute(self._d_left, self._d_right, self._d_disparity)
+            return self._d_disparity.download()
+        return matcher.compute(left_gray, right_gray, worker.buffer("raw_disparity", left_gray.shape, np.int16))
     
     def estimate_depth(self, left_image: np.ndarray, right_image: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[float]]:
         """
@@ -58,37 +195,57 @@ class StereoVision:
             # Convert to grayscale for stereo matching
             left_gray = cv2.cvtColor(left_image, cv2.COLOR_RGB2GRAY)
             right_gray = cv2.cvtColor(right_image, cv2.COLOR_RGB2GRAY)
-            
+        except Exception as e:
+            logger.error(f"Depth estimation failed: {e}")
+            return None, None
+        
+        with self.checkout() as worker:
+            depth_map, average_depth, _ = self._estimate_depth_stats(left_gray, right_gray, False, worker)
+            # The depth map lives in the worker's buffers, so hand back a copy
+            return (depth_map.copy() if depth_map is not None else None), average_depth
+    
+    def _estimate_depth_stats(self,
+                              left_gray: np.ndarray,
+                              right_gray: np.ndarray,
+                              fast: bool,
+                              worker: StereoWorker,
+                              target_window: Optional[Tuple[int, int, int, int]] = None):
+        """
+        Depth map in the worker's buffers plus its central mean and target-window std
+        
+        Returns:
+            Tuple of (depth_map, average_depth, target_std) or (None, None, None) if failed
+        """
+        try:
             # Compute disparity map
-            disparity = self.stereo.compute(left_gray, right_gray).astype(np.float32) / 16.0
+            raw_disparity = self.compute_raw_disparity(left_gray, right_gray, fast, worker)
             
-            # Convert disparity to depth
-            # depth = (baseline * focal_length) / disparity
-            # Avoid division by zero
-            disparity[disparity == 0] = 0.1
-            depth_map = (self.baseline * self.focal_length) / disparity
+            # depth = (baseline * focal_length) / disparity, with zero disparity guarded and
+            # the result clipped to 0.1m-50m, fused with the window reductions in one
+            # Numba pass
+            height, width = raw_disparity.shape
+            center = (height//4, 3*height//4, width//4, 3*width//4)
+            depth_map = worker.buffer("depth", (height, width), np.float32)
+            average_depth, target_std = disp_to_depth_stats(
+                raw_disparity, self.baseline * self.focal_length, depth_map,
+                center, target_window if target_window is not None else center
+            )
             
-            # Filter out unrealistic depths (too close or too far)
-            depth_map = np.clip(depth_map, 0.1, 50.0)  # 0.1m to 50m
+            # Average depth in the central region (of the frame or ROI passed in)
+            if (center[1] - center[0]) * (center[3] - center[2]) == 0:
+                average_depth = None
             
-            # Calculate average depth in central region
-            center_region = depth_map[
-                self.image_height//4:3*self.image_height//4,
-                self.image_width//4:3*self.image_width//4
-            ]
-            average_depth = np.mean(center_region) if center_region.size > 0 else None
-            
-            return depth_map, average_depth
+            return depth_map, average_depth, target_std
             
         except Exception as e:
             logger.error(f"Depth estimation failed: {e}")
-            return None, None
+            return None, None, None
     
     def detect_target_with_depth(self, 
                                 left_image: np.ndarray, 
                                 right_image: np.ndarray,
                                 target_color_hsv_low: np.ndarray,
-                                target_color_hsv_high: np.ndarray) -> Tuple[Optional[float], Optional[float], Optional[float]]:
+                                target_color_hsv_high: np.ndarray) -> Tuple[Optional[float], Optional[float], Optional[float], Optional[Tuple[int, int, int, int]]]:
         """
         Detect target with depth information
         
@@ -99,7 +256,8 @@ class StereoVision:
             target_color_hsv_high: Upper HSV bound for target color
             
         Returns:
-            Tuple of (distance_meters, angle_degrees, confidence) or (None, None, None)
+            Tuple of (distance_meters, angle_degrees, confidence, bbox) or (None, None, None, None),
+            where bbox is the target's (x, y, w, h) in the left image
         """
         try:
             # Convert to HSV for color detection
@@ -108,15 +266,15 @@ class StereoVision:
             # Create mask for target color
             mask = cv2.inRange(left_hsv, target_color_hsv_low, target_color_hsv_high)
             
-            # Find contours
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            # Label connected blobs; stats hold each blob's bbox and pixel area
+            num_labels, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
             
-            if not contours:
-                return None, None, None
+            if num_labels < 2:
+                return None, None, None, None
             
-            # Get largest contour
-            largest_contour = max(contours, key=cv2.contourArea)
-            x, y, w, h = cv2.boundingRect(largest_contour)
+            # Get largest blob (label 0 is the background)
+            largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+            x, y, w, h, contour_area = (int(v) for v in stats[largest])
             
             # Calculate target center in image coordinates
             center_x = x + w/2
@@ -127,32 +285,68 @@ class StereoVision:
             angle_rad = np.arctan2(center_x - self.image_width/2, self.focal_length)
             angle_deg = np.degrees(angle_rad)
             
-            # Estimate depth using stereo
-            depth_map, avg_depth = self.estimate_depth(left_image, right_image)
+            # Calculate confidence based on blob area and depth consistency
+            max_area = self.image_width * self.image_height
+            area_confidence = min(1.0, contour_area / (max_area * 0.01))
             
-            if depth_map is None or avg_depth is None:
-                return None, angle_deg, 0.5
+            # The monocular fallback passes the same image as both sides: the
+            # disparity would be all zeros, so skip stereo matching entirely
+            if right_image is left_image:
+                return None, angle_deg, area_confidence, (x, y, w, h)
             
-            # Get depth at target location
-            target_depth = depth_map[int(center_y), int(center_x)]
+            # Depth is only sampled inside the bbox, so match just that ROI: widened on
+            # the left by the disparity search range, plus a margin on every side
+            image_height, image_width = left_image.shape[:2]
+            x0 = max(0, x - NUM_DISPARITIES - ROI_MARGIN)
+            y0 = max(0, y - ROI_MARGIN)
+            # Targets near the left edge clamp x0 to 0; grow the ROI to the right so
+            # it stays wide enough for the matchers
+            x1 = min(image_width, max(x + w + ROI_MARGIN, x0 + MIN_ROI_WIDTH))
+            y1 = min(image_height, y + h + ROI_MARGIN)
+            left_roi = left_image[y0:y1, x0:x1]
+            right_roi = right_image[y0:y1, x0:x1]
             
-            # Calculate confidence based on contour area and depth consistency
-            contour_area = cv2.contourArea(largest_contour)
-            max_area = self.image_width * self.image_height
-            area_confidence = min(1.0, contour_area / (max_area * 0.01))
+            # Estimate depth using stereo; convert each ROI to grayscale once. Every
+            # intermediate lives in the borrowed worker's persistent buffers, and the
+            # depth map is only read before the worker goes back to the pool
+            roi_shape = left_roi.shape[:2]
+            with self.checkout() as worker:
+                left_gray = cv2.cvtColor(left_roi, cv2.COLOR_RGB2GRAY, dst=worker.buffer("left_gray", roi_shape, np.uint8))
+                right_gray = cv2.cvtColor(right_roi, cv2.COLOR_RGB2GRAY, dst=worker.buffer("right_gray", roi_shape, np.uint8))
+                fast = self.use_fast_matcher
+                while True:
+                    # Depth consistency (target should have consistent depth) comes out of
+                    # the same pass that builds the depth map
+                    depth_map, avg_depth, depth_std = self._estimate_depth_stats(
+                        left_gray, right_gray, fast, worker, target_window=(y - y0, y - y0 + h, x - x0, x - x0 + w)
+                    )
+                    
+                    if depth_map is None or avg_depth is None:
+                        # A failed block-matching pass gets the same SGBM retry as a noisy one
+                        if fast:
+                            fast = False
+                            continue
+                        return None, angle_deg, 0.5, (x, y, w, h)
+                    
+                    # Get depth at target location
+                    target_depth = depth_map[int(center_y) - y0, int(center_x) - x0]
+                    
+                    # Block matching is noisy on weak texture and leaves textureless targets
+                    # unmatched (clipped to 0.1m): redo the frame with SGBM in either case
+                    if not fast or (depth_std <= FAST_MATCHER_MAX_DEPTH_STD and target_depth > 0.1):
+                        break
+                    fast = False
             
-            # Depth consistency confidence (target should have consistent depth)
-            depth_region = depth_map[y:y+h, x:x+w]
-            depth_std = np.std(depth_region) if depth_region.size > 0 else 0
+            # Depth consistency confidence
             depth_confidence = 1.0 - min(1.0, depth_std / 5.0)  # Less confidence if depth varies
             
             confidence = (area_confidence * 0.6 + depth_confidence * 0.4)
             
-            return target_depth, angle_deg, confidence
+            return target_depth, angle_deg, confidence, (x, y, w, h)
             
         except Exception as e:
             logger.error(f"Target detection with depth failed: {e}")
-            return None, None, None
+            return None, None, None, None
     
     def get_navigation_command(self, 
                               distance: float, 
@@ -177,46 +371,25 @@ class StereoVision:
         angle_normalized = angle / 55.0
         angle_normalized = np.clip(angle_normalized, -1.0, 1.0)
         
-        # Navigation logic based on distance and angle
-        if distance < 1.0:  # Very close
-            if abs(angle_normalized) < 0.1:  # Centered
-                return "STOP", f"Target reached! Distance: {distance:.1f}m, Angle: {angle:.1f}°"
-            elif angle_normalized < -0.3:  # Left
-                return "LEFT", f"Target close at {distance:.1f}m, turning LEFT (angle: {angle:.1f}°)"
-            elif angle_normalized > 0.3:  # Right
-                return "RIGHT", f"Target close at {distance:.1f}m, turning RIGHT (angle: {angle:.1f}°)"
-            else:
-                return "FORWARD", f"Target close at {distance:.1f}m, moving FORWARD"
-        
-        elif distance < 5.0:  # Medium distance
-            if abs(angle_normalized) < 0.2:  # Somewhat centered
-                return "FORWARD", f"Target at medium distance {distance:.1f}m, moving FORWARD"
-            elif angle_normalized < -0.5:  # Far left
-                return "LEFT", f"Target at {distance:.1f}m, turning LEFT to center"
-            elif angle_normalized > 0.5:  # Far right
-                return "RIGHT", f"Target at {distance:.1f}m, turning RIGHT to center"
-            else:
-                return "FORWARD", f"Target at {distance:.1f}m, moving FORWARD while centering"
-        
-        else:  # Far away
-            if abs(angle_normalized) < 0.3:  # Reasonably centered
-                return "FORWARD", f"Target far away at {distance:.1f}m, moving FORWARD urgently"
-            elif angle_normalized < -0.7:  # Extreme left
-                return "LEFT", f"Target far at {distance:.1f}m, turning LEFT to find"
-            elif angle_normalized > 0.7:  # Extreme right
-                return "RIGHT", f"Target far at {distance:.1f}m, turning RIGHT to find"
-            else:
-                return "FORWARD", f"Target far at {distance:.1f}m, moving FORWARD to close distance"
+        # Navigation logic based on distance band and angle zone; at most one zone test
+        # holds (the centered threshold is always inside the side threshold)
+        band = bisect.bisect_right(NAVIGATION_DISTANCE_BANDS, distance)
+        centered, side = NAVIGATION_ANGLE_THRESHOLDS[band]
+        zone = 2 * (abs(angle_normalized) < centered) + (angle_normalized < -side) + 3 * (angle_normalized > side)
+        action, reasoning = NAVIGATION_TABLE[band][zone]
+        return action, reasoning.format(distance=distance, angle=angle)
 
-# Color ranges for different targets (HSV format)
+# Color ranges for different targets (HSV format), shared by every detector
 COLOR_RANGES = {
-    "Red Cube": (np.array([0, 120, 70]), np.array([10, 255, 255])),
-    "Pink Sphere": (np.array([150, 70, 70]), np.array([170, 255, 255])),
-    "Green Cone": (np.array([40, 80, 80]), np.array([80, 255, 255])),
-    "Yellow Cylinder": (np.array([20, 100, 100]), np.array([30, 255, 255])),
-    "Skeleton Head": (np.array([0, 0, 180]), np.array([180, 40, 255])),
+    "Red Cube": (np.array([0, 120, 70]), np.array([10, 255, 255])),  # Bright red
+    "Pink Sphere": (np.array([150, 70, 70]), np.array([170, 255, 255])),  # Pink/Magenta
+    "Green Cone": (np.array([40, 80, 80]), np.array([80, 255, 255])),  # Bright green
+    "Yellow Cylinder": (np.array([20, 100, 100]), np.array([30, 255, 255])),  # Bright yellow
+    "Skeleton Head": (np.array([0, 0, 180]), np.array([180, 40, 255])),  # Very light/white
 }
 
+# The frontend sends the same description every frame, so the scan runs once per target
+@functools.lru_cache(maxsize=64)
 def get_color_range(target_description: str):
     """Get HSV color range for target description"""
     for target, (low, high) in COLOR_RANGES.items():